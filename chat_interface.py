@@ -4,11 +4,11 @@ import logging
 from rag_backend import (
     check_aws_credentials,
     load_or_initialize_stores,
+    open_query_cache,
     generate_multimodal_embeddings,
     invoke_claude_3_multimodal,
-    save_stores
+    search_items
 )
-import numpy as np
 import sys
 import codecs
 
@@ -112,7 +112,7 @@ def main():
         st.stop()
     
     # Load stores (but don't initialize new ones)
-    index, all_items, query_embeddings_cache = load_or_initialize_stores()
+    index, all_items = load_or_initialize_stores(read_only=True)
     
     # Display chat history
     for message in st.session_state.chat_history:
@@ -130,22 +130,15 @@ def main():
             with st.spinner("Thinking..."):
                 if all_items:
                     # Generate query embedding
-                    if query in query_embeddings_cache:
-                        query_embedding = query_embeddings_cache[query]
-                    else:
+                    query_embeddings_cache = open_query_cache()
+                    query_embedding = query_embeddings_cache.get(query)
+                    if query_embedding is None:
                         query_embedding = generate_multimodal_embeddings(prompt=query)
-                        query_embeddings_cache[query] = query_embedding
-                        save_stores(index, all_items, query_embeddings_cache)
+                        query_embeddings_cache.put(query, query_embedding)
+                    query_embeddings_cache.close()
                     
                     # Search for relevant content
-                    distances, result = index.search(
-                        np.array(query_embedding, dtype=np.float32).reshape(1,-1), 
-                        k=5
-                    )
-                    
-                    # Get matched items
-                    matched_items = [{k: v for k, v in all_items[idx].items() if k != 'embedding'} 
-                                   for idx in result.flatten()]
+                    matched_items = search_items(index, all_items, query_embedding, k=5)
                     
                     # Generate and verify response
                     response = generate_and_verify_response(query, matched_items)
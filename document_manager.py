@@ -6,10 +6,10 @@ from rag_backend import (
     create_directories,
     process_pdf,
     load_or_initialize_stores,
-    generate_multimodal_embeddings,
+    generate_embeddings_bulk,
+    add_embeddings,
     save_stores
 )
-import numpy as np
 
 def get_pdf_download_link(pdf_path):
     """Generate a download link for a PDF file"""
@@ -151,7 +151,7 @@ def main():
         # Process uploaded files
         if uploaded_files:
             # Initialize stores
-            index, all_items, query_embeddings_cache = load_or_initialize_stores()
+            index, all_items = load_or_initialize_stores()
             
             for uploaded_file in uploaded_files:
                 items, filepath = process_pdf(uploaded_file)
@@ -159,16 +159,11 @@ def main():
                     st.success(f"Processed {uploaded_file.name}")
                     
                     with st.spinner("Generating embeddings..."):
-                        for item in items:
-                            if item['type'] in ['text', 'table']:
-                                item['embedding'] = generate_multimodal_embeddings(prompt=item['text'])
-                            else:
-                                item['embedding'] = generate_multimodal_embeddings(image=item['image'])
+                        new_embeddings = generate_embeddings_bulk(items)
                     
-                    new_embeddings = np.array([item['embedding'] for item in items])
-                    index.add(np.array(new_embeddings, dtype=np.float32))
+                    index = add_embeddings(index, new_embeddings)
                     all_items.extend(items)
-                    save_stores(index, all_items, query_embeddings_cache)
+                    save_stores(index, all_items)
     
     # Show document list and get selected document
     selected_file = show_document_list()
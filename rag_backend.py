@@ -1,24 +1,54 @@
 import boto3
-import tabula
 import faiss
 import json
+import orjson
 import base64
 import fitz as pymupdf
 import os
 import logging
 import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_aws import ChatBedrock
 import pickle
+import msgpack
+import numpy as np
 import re
+import sqlite3
+import hashlib
+import shutil
+import subprocess
+import tempfile
+from functools import lru_cache
+from pathlib import Path
 
 # Constants
 BASE_DIR = "data"
+MAX_PAGE_WORKERS = 6
+CHUNK_SIZE = 700
+CHUNK_OVERLAP = 200
+EMBEDDING_CONCURRENCY = 16
+PAGE_RENDER_DPI = 150
+PAGE_JPEG_QUALITY = 80
+EMBEDDING_DIMENSION = 384
+IVF_NLIST = 100
+IVF_NPROBE = 10
+IVF_TRAIN_THRESHOLD = 10 * IVF_NLIST
 VECTOR_STORE = "vector_store"
 FAISS_INDEX = "faiss.index"
+ITEMS_FILE = "items.msgpack"
+QUERY_EMBEDDINGS_CACHE = "query_embeddings.sqlite"
+# Pickle file written by earlier versions, read once for migration
 ITEMS_PICKLE = "items.pkl"
-QUERY_EMBEDDINGS_CACHE = "query_embeddings.pkl"
+# Query caches written by earlier versions; they hold raw query text and are deleted, not migrated
+LEGACY_QUERY_CACHES = ["query_embeddings.pkl", "query_embeddings.msgpack"]
+STORE_FORMAT_VERSION = 1
+FAISS_PATH = os.path.join(VECTOR_STORE, FAISS_INDEX)
+ITEMS_PATH = os.path.join(VECTOR_STORE, ITEMS_FILE)
+ITEMS_PICKLE_PATH = os.path.join(VECTOR_STORE, ITEMS_PICKLE)
+QCACHE_PATH = os.path.join(VECTOR_STORE, QUERY_EMBEDDINGS_CACHE)
+LEGACY_QCACHE_PATHS = [os.path.join(VECTOR_STORE, name) for name in LEGACY_QUERY_CACHES]
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
@@ -33,36 +63,25 @@ def create_directories():
     for subdir in subdirs:
         os.makedirs(os.path.join(BASE_DIR, subdir), exist_ok=True)
 
-def process_tables(doc, page_num, items, filepath):
+def process_tables(page, page_num, items, base):
     """Process tables with better table handling"""
     try:
-        tables = tabula.read_pdf(filepath, pages=page_num + 1, multiple_tables=True)
+        # pymupdf's native detector runs in-process, so text-only pages cost almost nothing
+        tables = page.find_tables().tables
         if not tables:
             return
-        for table_idx, table in enumerate(tables):
+        for table_idx, found_table in enumerate(tables):
+            table = found_table.to_pandas()
             # Skip empty tables
             if table.empty:
                 continue
                 
-            # Clean table data
-            table = table.fillna('')  # Handle NaN values
-            
-            # Create a more readable markdown table
-            headers = table.columns.tolist()
-            markdown_rows = []
-            
-            # Add headers
-            markdown_rows.append("| " + " | ".join(str(h) for h in headers) + " |")
-            markdown_rows.append("| " + " | ".join(['---' for _ in headers]) + " |")
-            
-            # Add data rows
-            for _, row in table.iterrows():
-                markdown_rows.append("| " + " | ".join(str(cell) for cell in row) + " |")
-            
-            table_text = f"### Table {table_idx + 1}\n" + "\n".join(markdown_rows)
+            # Clean NaN values and render the whole table as markdown in one pass
+            table_body = table.fillna('').to_markdown(index=False)
+            table_text = f"### Table {table_idx + 1}\n" + table_body
             
             table_file_name = os.path.join(BASE_DIR, "tables", 
-                f"{os.path.basename(filepath)}_table_{page_num}_{table_idx}.txt")
+                f"{base}_table_{page_num}_{table_idx}.txt")
                 
             with open(table_file_name, 'w', encoding='utf-8') as f:
                 f.write(table_text)
@@ -71,13 +90,29 @@ def process_tables(doc, page_num, items, filepath):
                 "page": page_num,
                 "type": "table",
                 "text": table_text,
-                "path": table_file_name,
-                "raw_table": table.to_dict('records')
+                "path": table_file_name
             })
     except Exception as e:
         logger.warning(f"Table processing error on page {page_num + 1}: {str(e)}")
 
-def process_text_chunks(text, text_splitter, page_num, items, filepath):
+def fast_split(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Split text into fixed-size overlapping chunks, starting each chunk on a word boundary"""
+    chunks = []
+    for start in range(0, len(text), size - overlap):
+        if start:
+            # Snap back to the preceding whitespace so chunks don't begin mid-word
+            boundary = max(text.rfind(' ', max(start - 32, 0), start), text.rfind('\n', max(start - 32, 0), start))
+            if boundary != -1:
+                start = boundary + 1
+        chunk = text[start:start + size].strip()
+        if chunk:
+            chunks.append(chunk)
+        # Anything after this chunk would be a subset of the overlap
+        if start + size >= len(text):
+            break
+    return chunks
+
+def process_text_chunks(text, page_num, items, base):
     """Enhanced text processing with better structure preservation"""
     import re
     
@@ -135,14 +170,13 @@ def process_text_chunks(text, text_splitter, page_num, items, filepath):
             
         return elements
     
-    def save_element(element, section_num):
-        """Save a structural element while preserving its format"""
+    # All chunks for the page go into one JSONL file; each item points at its line via "#i"
+    page_file = f"{BASE_DIR}/text/{base}_page_{page_num}.jsonl"
+    
+    def build_element(element, section_num):
+        """Build an item for a structural element while preserving its format"""
         content = '\n'.join(element['content'])
-        file_name = f"{BASE_DIR}/text/{os.path.basename(filepath)}_{element['type']}_{page_num}_{section_num}.txt"
         
-        with open(file_name, 'w', encoding='utf-8') as f:
-            f.write(content)
-            
         metadata = {
             'type': element['type'],
             'has_code': element['type'] == 'code',
@@ -155,51 +189,53 @@ def process_text_chunks(text, text_splitter, page_num, items, filepath):
             "page": page_num,
             "type": "text",
             "text": content,
-            "path": file_name,
+            "path": f"{page_file}#{section_num}",
             "metadata": metadata
         }
     
+    def write_page_file(page_items):
+        """Write every chunk of the page with a single open handle"""
+        with open(page_file, 'w', encoding='utf-8', buffering=1 << 16) as f:
+            for i, item in enumerate(page_items):
+                f.write(json.dumps({"i": i, "text": item['text']}, ensure_ascii=False) + '\n')
+    
     try:
         # First extract structural elements
         elements = extract_structure(text)
         
-        # Save elements while preserving their structure
-        for i, element in enumerate(elements):
-            item = save_element(element, i)
-            items.append(item)
+        # Keep elements with their structure
+        page_items = [build_element(element, i) for i, element in enumerate(elements)]
         
         # Process any remaining text traditionally
-        remaining_text = text_splitter.split_text(text)
-        for i, chunk in enumerate(remaining_text):
-            # Only save chunks that aren't part of structural elements
+        remaining_text = fast_split(text)
+        for chunk in remaining_text:
+            # Only keep chunks that aren't part of structural elements
             if not any(chunk in elem['content'] for elem in elements):
-                text_file_name = f"{BASE_DIR}/text/{os.path.basename(filepath)}_text_{page_num}_{i}.txt"
-                with open(text_file_name, 'w', encoding='utf-8') as f:
-                    f.write(chunk)
-                items.append({
+                page_items.append({
                     "page": page_num,
                     "type": "text",
                     "text": chunk,
-                    "path": text_file_name,
+                    "path": f"{page_file}#{len(page_items)}",
                     "metadata": {'type': 'text'}
                 })
+        
+        write_page_file(page_items)
+        items.extend(page_items)
                 
     except Exception as e:
         logger.error(f"Error processing text chunks on page {page_num}: {str(e)}")
         # Fall back to basic processing
-        chunks = text_splitter.split_text(text)
-        for i, chunk in enumerate(chunks):
-            text_file_name = f"{BASE_DIR}/text/{os.path.basename(filepath)}_text_{page_num}_{i}.txt"
-            with open(text_file_name, 'w', encoding='utf-8') as f:
-                f.write(chunk)
-            items.append({
-                "page": page_num,
-                "type": "text",
-                "text": chunk,
-                "path": text_file_name
-            })
+        chunks = fast_split(text)
+        page_items = [{
+            "page": page_num,
+            "type": "text",
+            "text": chunk,
+            "path": f"{page_file}#{i}"
+        } for i, chunk in enumerate(chunks)]
+        write_page_file(page_items)
+        items.extend(page_items)
 
-def process_images(page, page_num, items, filepath, doc):
+def process_images(page, page_num, items, base, doc):
     """Process images from PDF pages"""
     images = page.get_images()
     for idx, image in enumerate(images):
@@ -211,32 +247,95 @@ def process_images(page, page_num, items, filepath, doc):
             if pix.n - pix.alpha < 3:
                 pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
                 
+            # Name the file by content so repeated logos/watermarks share one file
+            content_hash = hashlib.blake2b(pix.samples, digest_size=16).hexdigest()
             image_name = os.path.join(BASE_DIR, "images", 
-                f"{os.path.basename(filepath)}_image_{page_num}_{idx}_{xref}.png")
+                f"{base}_image_{content_hash}.png")
             
-            # Save image without quality parameter
-            pix.save(image_name)
+            # Encode in memory and write once rather than letting pymupdf manage the file
+            if not os.path.exists(image_name):
+                Path(image_name).write_bytes(pix.tobytes("png"))
             
-            with open(image_name, 'rb') as f:
-                encoded_image = base64.b64encode(f.read()).decode('utf8')
+            # Only the path is kept; the bytes are read from disk when needed
             items.append({
                 "page": page_num,
                 "type": "image",
                 "path": image_name,
-                "image": encoded_image
+                "content_hash": content_hash
             })
         except Exception as e:
             logger.warning(f"Image processing error on page {page_num + 1}, image {idx}: {str(e)}")
             continue
 
-def process_page_images(page, page_num, items, filepath):
+def _page_image_path(base, page_num):
+    """Path of a page render; prefixed with the source file so documents don't overwrite each other"""
+    return os.path.join(BASE_DIR, "page_images", f"{base}_page-{page_num + 1:03d}.jpg")
+
+def render_all_pages(filepath, base):
+    """Render every page to JPEG with a single pdftoppm run, returning paths in page order"""
+    if shutil.which("pdftoppm") is None:
+        return []
+    # Render into a fresh directory so renders left over from earlier uploads are never picked up
+    with tempfile.TemporaryDirectory(dir=os.path.join(BASE_DIR, "page_images")) as render_dir:
+        try:
+            subprocess.run(
+                ["pdftoppm", "-jpeg", "-jpegopt", f"quality={PAGE_JPEG_QUALITY}",
+                 "-r", str(PAGE_RENDER_DPI), filepath, os.path.join(render_dir, "page")],
+                check=True, capture_output=True
+            )
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"Page rendering error for {filepath}: {e.stderr.decode(errors='replace')}")
+            return []
+        # pdftoppm names pages page-<n>.jpg, zero-padded to the page count's width;
+        # move them to the same fixed-width names the pymupdf fallback uses
+        pattern = re.compile(r'page-(\d+)\.jpg$')
+        page_paths = {}
+        for name in os.listdir(render_dir):
+            match = pattern.match(name)
+            if match:
+                page_num = int(match.group(1)) - 1
+                page_paths[page_num] = _page_image_path(base, page_num)
+                os.replace(os.path.join(render_dir, name), page_paths[page_num])
+    return [page_paths[n] for n in sorted(page_paths)]
+
+def process_page_images(page, page_num, items, base, page_path=None):
     """Process full page images"""
-    pix = page.get_pixmap()
-    page_path = os.path.join(BASE_DIR, f"page_images/page_{page_num:03d}.png")
-    pix.save(page_path)
-    with open(page_path, 'rb') as f:
-        page_image = base64.b64encode(f.read()).decode('utf8')
-    items.append({"page": page_num, "type": "page", "path": page_path, "image": page_image})
+    if page_path is None:
+        # Fall back to pymupdf when pdftoppm isn't available
+        pix = page.get_pixmap(dpi=PAGE_RENDER_DPI, alpha=False)
+        page_path = _page_image_path(base, page_num)
+        # Full-page renders are photographic, so JPEG is far smaller than lossless PNG
+        Path(page_path).write_bytes(pix.tobytes("jpeg", jpg_quality=PAGE_JPEG_QUALITY))
+    items.append({"page": page_num, "type": "page", "path": page_path})
+
+def read_image_b64(path):
+    """Read a saved image from disk as a base64 string"""
+    with open(path, 'rb') as f:
+        return base64.b64encode(f.read()).decode('utf8')
+
+@lru_cache(maxsize=64)
+def _cached_image_b64(path, mtime_ns):
+    return read_image_b64(path)
+
+def load_image_b64(path):
+    """Load a saved image as base64, cached until the file is rewritten"""
+    # Page renders keep their path when a same-named PDF is re-uploaded, so key on mtime too
+    return _cached_image_b64(path, os.stat(path).st_mtime_ns)
+
+def _process_one_page(filepath, base, page_num, page_path):
+    """Extract tables, text, images and the page render for a single page"""
+    # pymupdf documents can't be shared across processes, so each worker opens its own
+    items = []
+    with pymupdf.open(filepath) as doc:
+        page = doc[page_num]
+        text = page.get_text()
+        # Pages without a text layer (blank or scanned) have no tables or chunks to extract
+        if text.strip():
+            process_tables(page, page_num, items, base)
+            process_text_chunks(text, page_num, items, base)
+        process_images(page, page_num, items, base, doc)
+        process_page_images(page, page_num, items, base, page_path)
+    return items
 
 def process_pdf(uploaded_file):
     """Process uploaded PDF file and extract content"""
@@ -247,29 +346,55 @@ def process_pdf(uploaded_file):
     with open(filepath, "wb") as f:
         f.write(uploaded_file.getbuffer())
 
-    doc = pymupdf.open(filepath)
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=700, chunk_overlap=200, length_function=len)
-    items = []
+    with pymupdf.open(filepath) as doc:
+        page_count = len(doc)
 
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        text = page.get_text()
-        process_tables(doc, page_num, items, filepath)
-        process_text_chunks(text, text_splitter, page_num, items, filepath)
-        process_images(page, page_num, items, filepath, doc)
-        process_page_images(page, page_num, items, filepath)
+    base = os.path.basename(filepath)
+    page_paths = render_all_pages(filepath, base)
+    if len(page_paths) != page_count:
+        page_paths = [None] * page_count
+
+    # Pages are independent, so fan them out across worker processes
+    items = []
+    workers = max(1, min(os.cpu_count() or 1, MAX_PAGE_WORKERS, page_count))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for page_items in executor.map(
+            _process_one_page, [filepath] * page_count, [base] * page_count, range(page_count), page_paths
+        ):
+            items.extend(page_items)
+
+    # Mark repeated images so the embedding step can reuse the first occurrence
+    seen_hashes = {}
+    for item in items:
+        if item['type'] != 'image':
+            continue
+        if item['content_hash'] in seen_hashes:
+            item['dedup_of'] = seen_hashes[item['content_hash']]
+        else:
+            seen_hashes[item['content_hash']] = item['path']
 
     return items, filepath
 
+@lru_cache(maxsize=1)
+def _bedrock_client():
+    """Shared Bedrock runtime client so its connection pool is reused across calls"""
+    return boto3.client(
+        service_name="bedrock-runtime",
+        region_name="us-east-1",
+        config=Config(max_pool_connections=32, retries={'max_attempts': 5, 'mode': 'adaptive'})
+    )
+
+@lru_cache(maxsize=1)
+def _claude_client():
+    """Shared Claude chat model built on the cached Bedrock client"""
+    return ChatBedrock(model_id="anthropic.claude-3-sonnet-20240229-v1:0", client=_bedrock_client())
+
 def generate_multimodal_embeddings(prompt=None, image=None, output_embedding_length=384):
     """Generate embeddings using AWS Bedrock"""
     if not prompt and not image:
         raise ValueError("Please provide either a text prompt, base64 image, or both as input")
     
-    client = boto3.client(
-        service_name="bedrock-runtime",
-        region_name="us-east-1"
-    )
+    client = _bedrock_client()
     model_id = "amazon.titan-embed-image-v1"
     
     body = {"embeddingConfig": {"outputEmbeddingLength": output_embedding_length}}
@@ -291,62 +416,184 @@ def generate_multimodal_embeddings(prompt=None, image=None, output_embedding_len
         logger.error(f"Error generating embeddings: {str(err)}")
         return None
 
-def load_or_initialize_stores():
-    """Load or initialize vector store and cache with UTF-8 support"""
-    embedding_vector_dimension = 384
-    
-    if os.path.exists(os.path.join(VECTOR_STORE, FAISS_INDEX)):
-        index = faiss.read_index(os.path.join(VECTOR_STORE, FAISS_INDEX))
-        with open(os.path.join(VECTOR_STORE, ITEMS_PICKLE), 'rb') as f:
-            # Load with UTF-8 encoding handling
-            all_items = pickle.load(f)
-            # Ensure all text content is UTF-8
-            for item in all_items:
-                if 'text' in item:
-                    item['text'] = item['text'].encode('utf-8').decode('utf-8', errors='replace')
+def generate_embeddings_bulk(items, concurrency=EMBEDDING_CONCURRENCY):
+    """Embed all items concurrently, storing each under item['embedding'] and returning an (N, d) matrix
+
+    Items whose embedding fails are removed from items in place, so rows stay aligned with items.
+    """
+    # Titan has no batch endpoint, so overlap the round-trips on the shared, thread-safe client
+    def embed(item):
+        if item['type'] in ['text', 'table']:
+            return generate_multimodal_embeddings(prompt=item['text'])
+        # Each image is embedded once, so caching its bytes here would only hold memory
+        return generate_multimodal_embeddings(image=read_image_b64(item['path']))
+
+    unique_items = [item for item in items if 'dedup_of' not in item]
+    # Build the client here: lru_cache doesn't serialize misses, and concurrent
+    # boto3.client() calls on the default session race inside botocore
+    _bedrock_client()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for item, embedding in zip(unique_items, executor.map(embed, unique_items)):
+            item['embedding'] = embedding
+
+    # Duplicate images share the embedding of the item they were deduplicated against
+    embeddings_by_path = {item['path']: item['embedding'] for item in unique_items if item['type'] == 'image'}
+    for item in items:
+        if 'dedup_of' in item:
+            item['embedding'] = embeddings_by_path.get(item['dedup_of'])
+
+    # Drop items whose embedding failed so they never reach the index as NaN rows
+    failed = [item for item in items if item['embedding'] is None]
+    if failed:
+        logger.error(f"Dropping {len(failed)} item(s) whose embeddings could not be generated")
+        items[:] = [item for item in items if item['embedding'] is not None]
+
+    # One contiguous matrix so the index takes all vectors in a single add
+    embeddings = np.empty((len(items), EMBEDDING_DIMENSION), dtype=np.float32)
+    for row, item in enumerate(items):
+        embeddings[row] = item['embedding']
+    return embeddings
+
+def train_index(embeddings):
+    """Build a trained IVF index over the given embeddings"""
+    quantizer = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
+    index = faiss.IndexIVFScalarQuantizer(
+        quantizer, EMBEDDING_DIMENSION, IVF_NLIST, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2
+    )
+    index.train(embeddings)
+    index.add(embeddings)
+    index.nprobe = IVF_NPROBE
+    return index
+
+def add_embeddings(index, embeddings):
+    """Add embeddings to the index, migrating the flat buffer to IVF once it is large enough"""
+    index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+    # Small stores stay on the flat buffer until there is enough data to train the clusters
+    if not isinstance(index, faiss.IndexIVF) and index.ntotal >= IVF_TRAIN_THRESHOLD:
+        index = train_index(index.reconstruct_n(0, index.ntotal))
+    return index
+
+def qkey(query):
+    """16-byte digest used as the query cache key, so raw query text is never stored"""
+    return hashlib.blake2b(query.encode('utf-8', errors='replace'), digest_size=16).digest()
+
+class QueryCache:
+    """SQLite-backed cache of query embeddings, keyed by qkey(query)"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS qcache(key BLOB PRIMARY KEY, emb BLOB)")
+        self.conn.commit()
+
+    def get(self, query):
+        """Return the cached embedding for a query, or None"""
+        row = self.conn.execute("SELECT emb FROM qcache WHERE key = ?", (qkey(query),)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float16).astype(np.float32)
+
+    def put(self, query, embedding):
+        """Store a query embedding as float16 bytes"""
+        if embedding is None:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO qcache(key, emb) VALUES (?, ?)",
+            (qkey(query), np.asarray(embedding, dtype=np.float16).tobytes())
+        )
+        self.conn.commit()
+
+    def clear(self):
+        """Remove all cached embeddings"""
+        self.conn.execute("DELETE FROM qcache")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def _write_store_file(path, data):
+    """Write data as versioned msgpack"""
+    with open(path, 'wb') as f:
+        f.write(msgpack.packb({"version": STORE_FORMAT_VERSION, "data": data}, use_bin_type=True))
+
+def _read_store_file(path, legacy_path):
+    """Read a versioned msgpack file, falling back to the legacy pickle if only that exists"""
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            stored = msgpack.unpackb(f.read(), raw=False)
+        version = stored.get("version") if isinstance(stored, dict) else None
+        if version != STORE_FORMAT_VERSION:
+            message = f"Unsupported store format version {version!r} in {path}; expected {STORE_FORMAT_VERSION}"
+            logger.error(message)
+            raise ValueError(message)
+        return stored["data"]
+    if os.path.exists(legacy_path):
+        with open(legacy_path, 'rb') as f:
+            return pickle.load(f)
+    return None
+
+def search_items(index, all_items, query_embedding, k=5):
+    """Return the k stored items nearest to the query embedding, without their embeddings"""
+    query = np.ascontiguousarray(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1))
+    distances, result = index.search(query, k)
+    # IVF search pads with -1 when the probed lists hold fewer than k vectors
+    return [{key: value for key, value in all_items[idx].items() if key != 'embedding'}
+            for idx in result[0] if idx >= 0]
+
+def load_or_initialize_stores(read_only=False):
+    """Load or initialize vector store with UTF-8 support"""
+    if os.path.exists(FAISS_PATH):
+        if read_only:
+            # Memory-map the inverted lists so clusters are paged in on demand instead of read up front
+            index = faiss.read_index(FAISS_PATH, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        else:
+            index = faiss.read_index(FAISS_PATH)
+        if isinstance(index, faiss.IndexIVF):
+            index.nprobe = IVF_NPROBE
+        all_items = _read_store_file(ITEMS_PATH, ITEMS_PICKLE_PATH) or []
+        # Ensure all text content is UTF-8
+        for item in all_items:
+            if 'text' in item:
+                item['text'] = item['text'].encode('utf-8').decode('utf-8', errors='replace')
     else:
-        index = faiss.IndexFlatL2(embedding_vector_dimension)
+        # Vectors are stored as float16 codes, halving memory and scan bandwidth
+        index = faiss.IndexScalarQuantizer(EMBEDDING_DIMENSION, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
         all_items = []
     
-    query_cache_path = os.path.join(VECTOR_STORE, QUERY_EMBEDDINGS_CACHE)
-    if os.path.exists(query_cache_path):
-        with open(query_cache_path, 'rb') as f:
-            query_embeddings_cache = pickle.load(f)
-            # Ensure queries are UTF-8 encoded
-            query_embeddings_cache = {
-                k.encode('utf-8').decode('utf-8', errors='replace'): v 
-                for k, v in query_embeddings_cache.items()
-            }
-    else:
-        query_embeddings_cache = {}
-    
-    return index, all_items, query_embeddings_cache
+    return index, all_items
+
+def _remove_legacy_query_caches():
+    """Delete query caches from earlier versions so their raw query text doesn't linger on disk"""
+    for path in LEGACY_QCACHE_PATHS:
+        if os.path.exists(path):
+            os.remove(path)
+
+def open_query_cache():
+    """Open the query embedding cache, creating it if needed"""
+    os.makedirs(VECTOR_STORE, exist_ok=True)
+    _remove_legacy_query_caches()
+    return QueryCache(QCACHE_PATH)
 
-def save_stores(index, all_items, query_embeddings_cache):
+def save_stores(index, all_items):
     """Save vector store and cache with UTF-8 support"""
     os.makedirs(VECTOR_STORE, exist_ok=True)
     
-    faiss.write_index(index, os.path.join(VECTOR_STORE, FAISS_INDEX))
+    # Write then swap so readers that have the old index memory-mapped keep a valid file
+    faiss.write_index(index, FAISS_PATH + ".tmp")
+    os.replace(FAISS_PATH + ".tmp", FAISS_PATH)
     
     # Ensure UTF-8 encoding for text content before saving
     items_to_save = []
     for item in all_items:
         item_copy = item.copy()
+        # Older stores kept the base64 image inline; drop it now that it's loaded from the path
+        item_copy.pop('image', None)
         if 'text' in item_copy:
             item_copy['text'] = item_copy['text'].encode('utf-8').decode('utf-8', errors='replace')
         items_to_save.append(item_copy)
     
-    with open(os.path.join(VECTOR_STORE, ITEMS_PICKLE), 'wb') as f:
-        pickle.dump(items_to_save, f)
-    
-    # Ensure UTF-8 encoding for cache before saving
-    cache_to_save = {
-        k.encode('utf-8').decode('utf-8', errors='replace'): v 
-        for k, v in query_embeddings_cache.items()
-    }
-    
-    with open(os.path.join(VECTOR_STORE, QUERY_EMBEDDINGS_CACHE), 'wb') as f:
-        pickle.dump(cache_to_save, f)
+    _write_store_file(ITEMS_PATH, items_to_save)
 
 def invoke_claude_3_multimodal(prompt, matched_items):
     """Generate response using Claude 3 with integrated natural interaction and document accuracy"""
@@ -419,16 +666,15 @@ Remember: Be as engaging as Claude/ChatGPT while ensuring every piece of informa
         organized_content = []
         seen_sources = set()  # Track unique sources
         
-        for item in matched_items:
-            source_file = os.path.basename(item['path']).split('_')[0]
-            page_num = item['page'] + 1
-            source_info = f"[Source: {source_file}, page {page_num}]"
-            
+        source_keys = [(os.path.basename(item['path']).split('_')[0], item['page'] + 1) for item in matched_items]
+        
+        for item, source_key in zip(matched_items, source_keys):
             # Skip duplicate sources
-            source_key = (source_file, page_num)
             if source_key in seen_sources:
                 continue
             seen_sources.add(source_key)
+            source_file, page_num = source_key
+            source_info = f"[Source: {source_file}, page {page_num}]"
             
             content_entry = {
                 "source": source_info,
@@ -465,8 +711,8 @@ Remember: Be as engaging as Claude/ChatGPT while ensuring every piece of informa
                 
             elif item['type'] in ['image', 'page']:
                 content_entry["image"] = {
-                    "format": "png",
-                    "source": {"bytes": item['image']}
+                    "format": "jpeg" if item['path'].endswith('.jpg') else "png",
+                    "source": {"bytes": load_image_b64(item['path'])}
                 }
             
             organized_content.append(content_entry)
@@ -532,10 +778,10 @@ Response Requirements:
             "inferenceConfig": inference_params,
         }
         
-        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
-        client = ChatBedrock(model_id=model_id)
+        client = _claude_client()
         
-        response = client.invoke(json.dumps(request_body))
+        # The body is dominated by base64 image strings, which orjson serializes much faster
+        response = client.invoke(orjson.dumps(request_body).decode('utf-8'))
         response_content = response.content
         
         # Reference handling section:
@@ -592,7 +838,6 @@ def clear_vector_store():
     """Clear all stored vectors and caches"""
     try:
         if os.path.exists(VECTOR_STORE):
-            import shutil
             shutil.rmtree(VECTOR_STORE)
     except Exception as e:
         logger.error(f"Error clearing vector store: {str(e)}")
@@ -600,8 +845,11 @@ def clear_vector_store():
 def clear_history():
     """Clear the query history and cached responses"""
     try:
-        if os.path.exists(os.path.join(VECTOR_STORE, QUERY_EMBEDDINGS_CACHE)):
-            os.remove(os.path.join(VECTOR_STORE, QUERY_EMBEDDINGS_CACHE))
+        _remove_legacy_query_caches()
+        if os.path.exists(QCACHE_PATH):
+            query_cache = QueryCache(QCACHE_PATH)
+            query_cache.clear()
+            query_cache.close()
     except Exception as e:
         logger.error(f"Error clearing history: {str(e)}")
 